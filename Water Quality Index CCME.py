@@ -6,6 +6,10 @@ import pandas as pd
 import numpy as np
 import datetime as dt
 import math
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
 
 
 #This script executes calculations outlined in the CCME (Canadian Council of Ministers of the Environment) WQI methodology.
@@ -37,6 +41,18 @@ import math
 #	  1. Assigning a grade for each parameter over the timeline - grade score = avg. excursion + ratio of failed tests for the parameter (e.g. 0.03 = 3%)
 #	  2. Find the biggest contributing parameter that affects the WQI by taking the maximum grade score to have the worst contribution to the WQI
 #  assign_WQI - Use F1, F2 and F3 to assign the WQI over each timeline according to the CCME WQI
+#  bootstrap_WQI - (optional) resample the readings within each timeline to give a confidence interval for the WQI and the probability that the rating holds
+#
+#The following helper functions work on numpy arrays so they can be applied to many timelines or bootstrap replicates at once:
+#  reading_metrics - flags each reading as tested/failed and finds its excursion for every parameter
+#  WQI_from_totals - finds F1, F2, F3 and the WQI from the summed tests, failures and excursions per parameter
+#  rate_WQI - assigns the A-E rating to an array of WQI values
+#
+#The script can also be run as a local query server (set run_server to True) which answers WQI requests for any site and date range:
+#  load_readings - reads in a site's csv and cleanses it into one row per reading (also used by cleanse_data)
+#  load_site - loads a site's readings into memory as cumulative (prefix) sums of tests, failures and excursions
+#  query_site - finds the WQI, F1, F2, F3, parameter grades and biggest contributor between two dates from the cumulative sums
+#  serve_WQI - starts the HTTP server and reloads a site whenever its source file changes
 
 #Different periods can be analysed if you wish to uncomment the calling of functions within the code calling 'Day', 'Week, 'Season, or 'Year'
 
@@ -70,11 +86,95 @@ destination = r"C:\Users\hockind\Desktop\Hackathon\EcoDetection Data\Testing for
 
 tolerance = ['Na',1050,165,2000,15,[5.4,10.1],[6.8,8.0]]
 
+#Names of the parameters in the same order as tolerance
 
-def cleanse_data(data_source,reference,date_format,destination=destination):
+tolerance_mapping=['Total Nitrogen Approximation', 'Phosphate','Conductivity', 'Turbidity', 'Oxygen', 'pH']
+
+#A WQI is only reported for a timeline with more than min_tests tests (avg. 4 tests per day over a month) and more than min_parameters parameters tested
+
+min_tests = 120
+min_parameters = 2
+
+#Set bootstrap to True to add a confidence interval for the WQI and a rating stability probability (the share of replicates that keep the reported rating) to each timeline.
+#Replicates that fall below the min_tests or min_parameters cutoffs are not rated, the share of these is also added.
+#The readings within each timeline are resampled with replacement bootstrap_replicates times. Set bootstrap_seed to an integer to get repeatable intervals.
+
+bootstrap = False
+bootstrap_replicates = 1000
+confidence_level = 0.95
+bootstrap_seed = None
+
+#Set run_server to True to start a local query server instead of exporting to the destination. The sites in file_params are loaded into memory once and can be queried by reference code, e.g.
+#  http://127.0.0.1:8050/wqi?site=cw_a&start=2023-03-14&end=2023-05-03
+#start is inclusive and end is exclusive, either can be left out to use the first/last reading. Dates are in the local time of the readings and should not include a time zone. http://127.0.0.1:8050/sites lists the loaded sites.
+#Query values are form encoded, so a + is read as a space. A time zone offset has to be sent as %2B (e.g. %2B10:00) to be recognised and rejected.
+
+run_server = False
+server_address = ('127.0.0.1', 8050)
+
+
+#Flag every reading as tested (not NA) and failed (outside the ERS bounds) and find its excursion for each parameter
+#values is an array of readings (rows) by parameters (columns) in the same order as tolerance
+
+def reading_metrics(values):
+
+    values = np.asarray(values, dtype=float)
+    tests = ~np.isnan(values)
+    failures = np.zeros(values.shape, dtype=bool)
+    excursions = np.zeros(values.shape)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for j in range(1,len(tolerance)):
+            column = values[:,j-1]
+            if j in range(1,len(tolerance)-2):
+                over = column > float(tolerance[j])
+                failures[:,j-1] = over
+                excursions[:,j-1] = np.where(over, column/float(tolerance[j])-1, 0)
+    #Special case for pH and oxygen which should be within a range
+            else:
+                under = column < float(tolerance[j][0])
+                over = column > float(tolerance[j][1])
+                failures[:,j-1] = under | over
+                excursions[:,j-1] = np.where(under, float(tolerance[j][0])/column-1, np.where(over, column/float(tolerance[j][1])-1, 0))
+
+    return tests, failures, excursions
+
+
+#Find F1, F2, F3 and WQI from the number of tests, failures and the sum of excursions for each parameter
+#The last axis of each array is the parameter, any leading axes (e.g. timelines or bootstrap replicates) are kept
+
+def WQI_from_totals(tests, failures, excursions):
+
+    tests = np.asarray(tests, dtype=float)
+    failures = np.asarray(failures, dtype=float)
+    excursions = np.asarray(excursions, dtype=float)
+
+    total_tests = tests.sum(axis=-1)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        F1 = np.count_nonzero(failures, axis=-1)/np.count_nonzero(tests, axis=-1)*100
+        F2 = failures.sum(axis=-1)/total_tests*100
+        nse = excursions.sum(axis=-1)/total_tests
+        F3 = nse/(0.01*nse+0.01)
+
+    WQI = 100-np.sqrt((F1**2+F2**2+F3**2)/3)
 
+    return F1, F2, F3, WQI
 
 
+#Assign the WQI rating to an array of WQI values
+
+def rate_WQI(WQI):
+
+    WQI = np.asarray(WQI, dtype=float)
+
+    return np.select([WQI>=95, WQI>=80, WQI>=65, WQI>=45], ['A','B','C','D'], 'E')
+
+
+#Read in a site's data from csv and cleanse it into one row per reading with the Timestamp followed by the parameters in the same order as tolerance
+
+def load_readings(data_source,date_format):
+
     #Read in data from csv
         
     data = pd.read_csv(data_source)
@@ -101,12 +201,51 @@ def cleanse_data(data_source,reference,date_format,destination=destination):
 
     data.drop([0,1], inplace= True)
 
+    data.dropna(subset=['Timestamp'],inplace=True)
 
-    #Create index values and columns for daily, weekly, monthly, seasonly and yearly
+    data['Timestamp'] = pd.to_datetime(data['Timestamp'], format = date_format)
 
+    #Drop Enclosure Temperature column as it is not needed for analysis
+
+    data = data.drop(['Enclosure Temperature'],axis = 1)
+
+    #Remove measurements of Oxygen and pH that = 0, this is not realistic. Reassign these values as NA
+
+    data['Oxygen']=data['Oxygen'].replace('0', np.nan)
+    data['pH']=data['pH'].replace('0', np.nan)
+
+    #Calculate 'Total Nitrogen' as Nitrate + Nitrite
+
+    total_nitrogen = []
     
-    
-    data.dropna(subset=['Timestamp'],inplace=True)
+    for i in range(len(data)):
+        if float(data['Nitrate Concentration'].values[i])>= 0 and float(data['Nitrite Concentration'].values[i])>=0:
+            total_nitrogen.append(float(data['Nitrate Concentration'].values[i])+float(data['Nitrite Concentration'].values[i]))
+        elif float(data['Nitrate Concentration'].values[i])>=0:
+            total_nitrogen.append(float(data['Nitrate Concentration'].values[i]))
+        elif float(data['Nitrite Concentration'].values[i])>=0:
+            total_nitrogen.append(float(data['Nitrite Concentration'].values[i]))
+        else:
+            total_nitrogen.append(None)
+
+
+    data.insert(1,'Total Nitrogen Approximation',total_nitrogen)
+
+    #Drop unneccesary columns
+
+    data.drop(['Chloride Concentration','Fluoride Concentration','Sulphate Concentration', 'Nitrate Concentration', 'Nitrite Concentration'],axis=1,inplace=True)
+
+    return data
+
+
+def cleanse_data(data_source,reference,date_format,destination=destination):
+
+
+
+    data = load_readings(data_source,date_format)
+
+
+    #Create index values and columns for daily, weekly, monthly, seasonly and yearly
 
     
     day_index = []
@@ -117,8 +256,6 @@ def cleanse_data(data_source,reference,date_format,destination=destination):
 
     #Pick desired value (day,week,month etc.) from date string and append to applicable index list
     
-    data['Timestamp'] = pd.to_datetime(data['Timestamp'], format = date_format)
-    
     for i in range(len(data)):
 
         #data.iat[i,0]=dt.datetime.strptime(str(data.iat[i,0]), date_format)
@@ -139,45 +276,11 @@ def cleanse_data(data_source,reference,date_format,destination=destination):
     data['Season Index']=season_index
     data['Year Index']=year_index
 
-    #Drop Enclosure Temperature column as it is not needed for analysis
-
-    data = data.drop(['Enclosure Temperature'],axis = 1)
-
-    #Remove measurements of Oxygen and pH that = 0, this is not realistic. Reassign these values as NA
-
-    data['Oxygen']=data['Oxygen'].replace('0', np.nan)
-    data['pH']=data['pH'].replace('0', np.nan)
-
     #Assign no. of parameters
 
     no_parameters = len(tolerance)-1
 
 
-
-    
-
-    #Calculate 'Total Nitrogen' as Nitrate + Nitrite
-
-    total_nitrogen = []
-    
-    for i in range(len(data)):
-        if float(data['Nitrate Concentration'].values[i])>= 0 and float(data['Nitrite Concentration'].values[i])>=0:
-            total_nitrogen.append(float(data['Nitrate Concentration'].values[i])+float(data['Nitrite Concentration'].values[i]))
-        elif float(data['Nitrate Concentration'].values[i])>=0:
-            total_nitrogen.append(float(data['Nitrate Concentration'].values[i]))
-        elif float(data['Nitrite Concentration'].values[i])>=0:
-            total_nitrogen.append(float(data['Nitrite Concentration'].values[i]))
-        else:
-            total_nitrogen.append(None)
-
-
-    data.insert(1,'Total Nitrogen Approximation',total_nitrogen)
-
-    #Drop unneccesary columns
-
-    data.drop(['Chloride Concentration','Fluoride Concentration','Sulphate Concentration', 'Nitrate Concentration', 'Nitrite Concentration'],axis=1,inplace=True)
-
-
                 
     #Count no. of failures for each row - 7 is used to replace the NAs as it is within range for all values, this does not affect total test count (i.e. improve percentage of successful scores)
     #Turn NaN into 0 in THIS dataframe
@@ -482,8 +585,6 @@ def cleanse_data(data_source,reference,date_format,destination=destination):
     #Assign grading for each parameter over timeline to align with grading of WQI (same banding)
     #The grading is based off the average excursion for each parameter + the percentage of failed tests for the parameter over the timeline
         
-        tolerance_mapping=['Total Nitrogen Approximation', 'Phosphate','Conductivity', 'Turbidity', 'Oxygen', 'pH']
-
         def parameter_grading(parameter):
 
             parameter_metrics=[row[:] for row in avg_excursion]
@@ -638,6 +739,60 @@ def cleanse_data(data_source,reference,date_format,destination=destination):
     #assign_WQI('Season')
     #assign_WQI('Year')
 
+    #Build function to find a bootstrap confidence interval for the WQI over every timeline
+    #Resampling n readings with replacement is the same as weighting each reading by a multinomial count, so every replicate for a timeline is found at once with a matrix product
+
+    def bootstrap_WQI(timeline):
+
+        tests, failures, excursions = reading_metrics(data.iloc[:,1:len(tolerance)].values)
+
+        index = data[f'{timeline} Index'].values
+        starts = np.flatnonzero(np.r_[True, index[1:]!=index[:-1]])
+        ends = np.r_[starts[1:], len(data)]
+
+        rng = np.random.default_rng(bootstrap_seed)
+        alpha = (1-confidence_level)/2
+
+        lower_bound = [None for i in range(len(data))]
+        upper_bound = [None for i in range(len(data))]
+        rating_stability = [None for i in range(len(data))]
+        below_cutoff = [None for i in range(len(data))]
+
+        for start, end in zip(starts, ends):
+            rating = data[f'WQI rating over {timeline}'].values[end-1]
+            if rating is None:
+                continue
+
+            n = end-start
+            weights = rng.multinomial(n, np.full(n, 1/n), size=bootstrap_replicates).astype(float)
+
+            replicate_tests = weights @ tests[start:end]
+
+            F1, F2, F3, WQI = WQI_from_totals(replicate_tests, weights @ failures[start:end], weights @ excursions[start:end])
+
+            #A replicate with min_tests tests or fewer, or min_parameters parameters or fewer, would not be rated by cleanse_data
+            #These replicates are left out of the interval and count as not keeping the rating
+
+            rated = (replicate_tests.sum(axis=-1)>min_tests) & (np.count_nonzero(replicate_tests, axis=-1)>min_parameters) & np.isfinite(WQI)
+
+            below_cutoff[end-1] = np.mean(~rated)
+            rating_stability[end-1] = np.mean(rated & (rate_WQI(WQI)==rating))
+
+            if np.any(rated):
+                lower_bound[end-1], upper_bound[end-1] = np.quantile(WQI[rated], [alpha, 1-alpha])
+
+        data[f'WQI lower bound over {timeline}']=lower_bound
+        data[f'WQI upper bound over {timeline}']=upper_bound
+        data[f'WQI rating stability over {timeline}']=rating_stability
+        data[f'WQI replicates below cutoff over {timeline}']=below_cutoff
+
+    if bootstrap:
+        #bootstrap_WQI('Day')
+        #bootstrap_WQI('Week')
+        bootstrap_WQI('Month')
+        #bootstrap_WQI('Season')
+        #bootstrap_WQI('Year')
+
 
 
     #Remove unneccessary columns - all columns with measurements and used for calculations 
@@ -659,8 +814,8 @@ def cleanse_data(data_source,reference,date_format,destination=destination):
         
     #Remove rows with WQI where parameters tested < 3 and total tests < 120 (avg. 4 tests per day)
 
-    data.drop(data[data['Total tests over Month']<=120].index,inplace=True)
-    data.drop(data[data['Total parameters over Month']<=2].index,inplace=True)
+    data.drop(data[data['Total tests over Month']<=min_tests].index,inplace=True)
+    data.drop(data[data['Total parameters over Month']<=min_parameters].index,inplace=True)
         
     data.drop(data.iloc[:,1:24],axis=1,inplace=True)
     data.drop(data.columns[7],axis=1,inplace=True)
@@ -670,13 +825,194 @@ def cleanse_data(data_source,reference,date_format,destination=destination):
 
     data.to_csv(destination, mode='a', index=False, header=is_first_file)
 
-#Run the function over each file defined in file_params
+#Load a site into memory for the query server
+#The tests, failures and excursions for each parameter are stored as cumulative sums over the readings (with a leading row of zeros) so the totals between any two readings are found by a subtraction
 
-    
-for i, params in enumerate(file_params):
-    is_first_file = (i == 0)   
-    cleanse_data(params[0], params[1], params[2])
+def load_site(data_source,date_format):
+
+    #Check the modified time before reading so a change made while reading triggers another reload
+
+    modified = os.path.getmtime(data_source)
+
+    readings = load_readings(data_source,date_format).sort_values('Timestamp')
+
+    tests, failures, excursions = reading_metrics(readings.iloc[:,1:len(tolerance)].values)
+
+    def prefix_sum(values):
+        return np.vstack([np.zeros((1,values.shape[1])), np.cumsum(values, axis=0)])
+
+    return {'source': data_source,
+            'date_format': date_format,
+            'modified': modified,
+            'timestamps': readings['Timestamp'].values,
+            'tests': prefix_sum(tests.astype(int)),
+            'failures': prefix_sum(failures.astype(int)),
+            'excursions': prefix_sum(excursions)}
+
+
+#Find the WQI for a site between two dates (start inclusive, end exclusive) using the cumulative sums from load_site
+
+def query_site(site,start_date=None,end_date=None):
+
+    timestamps = site['timestamps']
+
+    #The readings are in the site's local time without a time zone, so dates with a time zone cannot be compared to them
+
+    def parse_date(date):
+        if date is None:
+            return None
+        try:
+            date = pd.Timestamp(date)
+        except (ValueError, TypeError, OverflowError) as error:
+            raise ValueError(f'Could not read the date {date}: {error}')
+        if pd.isna(date):
+            raise ValueError(f'{date} is not a date')
+        if date.tzinfo is not None:
+            raise ValueError(f'{date} has a time zone, dates should be given in the local time of the readings')
+        return date
+
+    start_date = parse_date(start_date)
+    end_date = parse_date(end_date)
+
+    if start_date is not None and end_date is not None and start_date > end_date:
+        raise ValueError(f'start {start_date} is after end {end_date}')
+
+    first = 0 if start_date is None else np.searchsorted(timestamps, np.datetime64(start_date), side='left')
+    last = len(timestamps) if end_date is None else np.searchsorted(timestamps, np.datetime64(end_date), side='left')
+
+    tests = site['tests'][last]-site['tests'][first]
+    failures = site['failures'][last]-site['failures'][first]
+    excursions = site['excursions'][last]-site['excursions'][first]
+
+    result = {'Readings': int(last-first), 'Total tests': int(tests.sum()), 'Total parameters': int(np.count_nonzero(tests))}
+
+    #Apply the same cutoffs as cleanse_data so a range is only rated when the exported file would have rated it
+
+    result['Rated'] = result['Total tests']>min_tests and result['Total parameters']>min_parameters
+
+    if not result['Rated']:
+        return result
+
+    F1, F2, F3, WQI = WQI_from_totals(tests, failures, excursions)
+
+    result['F1'] = float(F1)
+    result['F2'] = float(F2)
+    result['F3'] = float(F3)
+    result['WQI'] = float(WQI)
+    result['WQI rating'] = str(rate_WQI(WQI))
+
+    #Grade each parameter with the same banding as assign_F3 - grade score = avg. excursion + ratio of failed tests for the parameter
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        parameter_metrics = np.where(tests>0, (excursions+failures)/tests, 0)
+
+    grades = np.select([parameter_metrics<=0.05, parameter_metrics<=0.2, parameter_metrics<=0.35, parameter_metrics<=0.55, parameter_metrics<=1], ['A','B','C','D','E'], 'F')
+
+    result['Grades'] = {parameter: (str(grades[j]) if tests[j]>0 else 'NA') for j, parameter in enumerate(tolerance_mapping)}
+
+    if np.count_nonzero(parameter_metrics)>=1:
+        result['Biggest contributor'] = tolerance_mapping[int(np.argmax(parameter_metrics))]
+    else:
+        result['Biggest contributor'] = 'All values within range'
+
+    return result
+
+
+#Start the query server for the sites defined in file_params. A site is reloaded on the next request after its source file changes
+#Every answer has a Stale field which is true when the copy in memory no longer matches the source file (the file is missing, could not be read or is being reloaded)
+
+def serve_WQI(file_params,server_address=server_address):
+
+    sites = {}
+    failed_reloads = {}
+    reload_locks = {}
+
+    for params in file_params:
+        sites[params[1]] = load_site(params[0], params[2])
+        reload_locks[params[1]] = threading.Lock()
+
+    #If a source file is missing or cannot be read (e.g. the logger is part way through writing it) keep serving the copy in memory
+    #A failed reload is not retried until the file changes again
+    #Only one thread reloads a site at a time, every other query (for this site or any other) keeps using the copy in memory until the new copy is swapped in
+
+    #Returns the site and whether it is stale
+
+    def get_site(reference):
+        site = sites[reference]
+
+        try:
+            modified = os.path.getmtime(site['source'])
+        except OSError as error:
+            print(f'Could not check {site["source"]} for {reference}, serving the copy already in memory:', repr(error))
+            return site, True
+
+        if modified == site['modified']:
+            return site, False
+
+        if modified == failed_reloads.get(reference) or not reload_locks[reference].acquire(blocking=False):
+            return site, True
+
+        try:
+            site = sites[reference]
+            if modified != site['modified']:
+                site = load_site(site['source'], site['date_format'])
+                sites[reference] = site
+            stale = False
+        except Exception as error:
+            failed_reloads[reference] = modified
+            print(f'Could not reload {site["source"]} for {reference}, serving the copy already in memory:', repr(error))
+            stale = True
+        finally:
+            reload_locks[reference].release()
+
+        return site, stale
+
+    class WQIRequestHandler(BaseHTTPRequestHandler):
+
+        def send_json(self,status,body):
+            content = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+
+            if url.path == '/sites':
+                self.send_json(200, sorted(sites))
+            elif url.path == '/wqi':
+                if query.get('site') not in sites:
+                    self.send_json(404, {'error': f"Unknown site {query.get('site')}"})
+                    return
+                site, stale = get_site(query['site'])
+                try:
+                    result = query_site(site, query.get('start'), query.get('end'))
+                except ValueError as error:
+                    self.send_json(400, {'error': str(error)})
+                    return
+                self.send_json(200, {'Site': query['site'], 'Start': query.get('start'), 'End': query.get('end'), 'Stale': stale, **result})
+            else:
+                self.send_json(404, {'error': f'Unknown path {url.path}'})
+
+    server = ThreadingHTTPServer(server_address, WQIRequestHandler)
+
+    print('Loaded sites in:', (float(time.time())-float(start)))
+    print(f'Serving WQI queries on http://{server_address[0]}:{server_address[1]}')
+
+    server.serve_forever()
+
+#Run the function over each file defined in file_params, or start the query server
+
+if run_server:
+    serve_WQI(file_params)
+else:
+    for i, params in enumerate(file_params):
+        is_first_file = (i == 0)   
+        cleanse_data(params[0], params[1], params[2])
 
-end = time.time()
+    end = time.time()
 
-print('Run time:', (float(end)-float(start)))
+    print('Run time:', (float(end)-float(start)))